@@ -1,5 +1,4 @@
 import torch
-from torch.autograd import Variable
 import torch.nn as nn
 import torch.nn.functional as F
 import torch.optim as optim
@@ -26,7 +25,6 @@ def prepare_data(data, labels):
     inputs = np.transpose(inputs, (0, 3, 1, 2))
     inputs = torch.from_numpy(inputs)
     labels = torch.from_numpy(labels)
-    inputs, labels = Variable(inputs), Variable(labels)
     inputs, labels = inputs.cuda(), labels.cuda()
     return inputs, labels
 
@@ -1,18 +1,28 @@
 import os
 import gc
+import copy
 import sys
 import argparse
 from itertools import product
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor
 from time import time
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 import torch.optim as optim
+import torch.utils.checkpoint
 from torchsummary import summary
 import numpy as np
-from scipy.io import savemat, loadmat
+from scipy.io import savemat
 from utils import elapsed_time
 from params import TIME_TRIAL_LENGTH
-from dataloaders import create_loaders
+from dataloaders import (
+    create_loaders,
+    fits_on_gpu,
+    CudaPrefetcher,
+    GPUBatchLoader,
+)
 
 parser = argparse.ArgumentParser()
 parser.add_argument(
@@ -91,19 +101,166 @@ parser.add_argument(
     type=int,
     help="the number of channels for the first convolution, the other channel numbers scale with this one",
 )
+parser.add_argument(
+    "--amp",
+    action="store_true",
+    help="use automatic mixed precision for training and evaluation (needs CUDA)",
+)
+parser.add_argument(
+    "--compile",
+    action="store_true",
+    help="compile the network (torch.compile, or TorchScript on older PyTorch)",
+)
+parser.add_argument(
+    "--no-pin-memory",
+    action="store_true",
+    help="do not use page-locked memory for the batches (uses less host memory)",
+)
+parser.add_argument(
+    "--num-workers",
+    default=4,
+    type=int,
+    help="The number of DataLoader worker processes, default=4",
+)
+parser.add_argument(
+    "--prefetch-factor",
+    default=2,
+    type=int,
+    help="The number of batches loaded in advance by each worker, default=2",
+)
+parser.add_argument(
+    "--matlab-compat",
+    action="store_true",
+    help="also save the training history as a .mat file once training ends",
+)
+parser.add_argument(
+    "--in-memory-gpu",
+    action="store_true",
+    help="load each dataset on the GPU once if it fits in half of the free memory",
+)
+parser.add_argument(
+    "--eval-train",
+    action="store_true",
+    help="evaluate the training set in eval mode after each epoch (slower)",
+)
+parser.add_argument(
+    "--h5-file",
+    default=None,
+    type=str,
+    help="read the temporal samples from this HDF5 store (see npy2h5.py)",
+)
+parser.add_argument(
+    "--checkpoint",
+    action="store_true",
+    help="use gradient checkpointing to save GPU memory and allow bigger batches",
+)
 
 
 def accuracy(y_pred, target):
-    correct = torch.eq(y_pred.max(1)[1], target).sum().type(torch.FloatTensor)
-    return correct / len(target)
+    return (y_pred.argmax(1) == target).float().mean()
+
+
+def _conv_out(L, k, s=1, p=0):
+    """Output length along one axis of a convolution or pooling layer."""
+    return (L + 2 * p - k) // s + 1
 
 
 class Flatten(nn.Module):
     def forward(self, x):
-        x = x.view(x.size(0), -1)
+        # reshape, not view: channels_last activations are not contiguous
+        x = x.reshape(x.size(0), -1)
         return x
 
 
+class _RestoreBatchNorm:
+    """Puts the BatchNorm buffers back after a checkpointed segment is recomputed.
+
+    The recomputation runs the layers in train mode a second time, which would
+    otherwise update the running statistics twice for the same batch.
+    """
+
+    def __init__(self, layers):
+        bn_types = nn.modules.batchnorm._BatchNorm
+        self.bns = [m for m in layers.modules() if isinstance(m, bn_types)]
+
+    def __enter__(self):
+        self.saved = [[b.clone() for b in bn.buffers()] for bn in self.bns]
+
+    def __exit__(self, *exc):
+        with torch.no_grad():
+            for bn, saved in zip(self.bns, self.saved):
+                for b, s in zip(bn.buffers(), saved):
+                    b.copy_(s)
+
+
+@torch.compiler.disable
+def checkpoint_sequential(model, segments, x):
+    """Same as torch's checkpoint_sequential, without counting the recomputed
+    batches twice in the BatchNorm running statistics.
+
+    Dynamo can not trace the custom context_fn, so under torch.compile the
+    checkpointed layers run eagerly.
+    """
+    size = len(model) // segments
+    for start in range(0, size * (segments - 1), size):
+        segment = model[start : start + size]
+        x = torch.utils.checkpoint.checkpoint(
+            segment,
+            x,
+            use_reentrant=False,
+            context_fn=lambda seg=segment: (nullcontext(), _RestoreBatchNorm(seg)),
+        )
+    return model[size * (segments - 1) :](x)
+
+
+def unwrap(net):
+    """Returns the module wrapped by torch.compile, or net if it is not compiled."""
+    return getattr(net, "_orig_mod", net)
+
+
+def fuse_conv_bn(net):
+    """Returns a copy of net with each BatchNorm folded into the preceding conv.
+
+    The running statistics are baked in the convolution weights so the copy
+    must only be used in eval mode.
+    """
+    net = copy.deepcopy(unwrap(net))
+    layers = net.model
+    if not isinstance(layers, nn.Sequential):
+        return net
+    for i in range(len(layers) - 1):
+        conv, bn = layers[i], layers[i + 1]
+        if isinstance(conv, nn.Conv2d) and isinstance(bn, nn.BatchNorm2d):
+            scale = bn.weight / torch.sqrt(bn.running_var + bn.eps)
+            with torch.no_grad():
+                conv.weight.mul_(scale.reshape(-1, 1, 1, 1))
+                if conv.bias is None:
+                    bias = torch.zeros_like(bn.running_mean)
+                else:
+                    bias = conv.bias
+                conv.bias = nn.Parameter((bias - bn.running_mean) * scale + bn.bias)
+            layers[i + 1] = nn.Identity()
+    return net
+
+
+class SpatialLinear(nn.Module):
+    """Same as nn.Conv2d(in_channels, out_channels, (height, 1)) on inputs of
+    that height, computed as one matrix product over all time points.
+
+    (B, C, height, T) -> (B, out_channels, 1, T)
+    """
+
+    def __init__(self, in_channels, out_channels, height):
+        super(SpatialLinear, self).__init__()
+        self.linear = nn.Linear(in_channels * height, out_channels)
+
+    def forward(self, x):
+        B, C, H, T = x.shape
+        x = x.permute(0, 3, 1, 2).reshape(B * T, C * H)
+        x = self.linear(x)
+        return x.reshape(B, T, -1, 1).permute(0, 2, 3, 1)
+
+
 def load_checkpoint(filename):
     print("=> loading checkpoint '{}'".format(filename))
     checkpoint = torch.load(filename)
@@ -117,17 +274,32 @@ def save_checkpoint(state, filename="checkpoint.pth.tar"):
     torch.save(state, filename)
 
 
+def save_results(results, filename):
+    # write to a temporary file first so an interrupted run can not leave a
+    # truncated results file behind
+    torch.save(results, filename + ".tmp")
+    os.replace(filename + ".tmp", filename)
+
+
 def train(
     net,
     trainloader,
     validloader,
     model_filepath,
-    criterion=nn.CrossEntropyLoss(),
+    criterion=F.cross_entropy,
     optimizer=optim.Adam,
     save_model=False,
     load_model=False,
     debug=False,
+    amp=False,
+    matlab_compat=False,
+    eval_train=False,
 ):
+    scaler = torch.amp.GradScaler("cuda", enabled=amp)
+    # checkpoints are written in the background while the next epoch trains
+    executor = ThreadPoolExecutor(max_workers=1)
+    pending = []
+    results_filepath = model_filepath[:-3] + "_results.pt"
     if debug:
         optimizer = optimizer(net.parameters())
     else:
@@ -135,9 +307,9 @@ def train(
 
     if load_model and os.path.exists(model_filepath):
         epoch, net_state, optimizer_state = load_checkpoint(model_filepath)
-        net.load_state_dict(net_state)
+        unwrap(net).load_state_dict(net_state)
         optimizer.load_state_dict(optimizer_state)
-        results = loadmat(model_filepath[:-2] + "mat")
+        results = torch.load(results_filepath)
         best_vacc = results["acc_score"]
         best_vloss = results["loss_score"]
         valid_accs = results["acc"]
@@ -148,36 +320,57 @@ def train(
         epoch = results["n_epochs"]
     else:
         epoch = 0
+        train_accs = []
+        valid_accs = []
+        train_losses = []
+        valid_losses = []
+        best_vloss = float("inf")
 
     p = PATIENCE
     j = 0
-    train_accs = []
-    valid_accs = []
-    train_losses = []
-    valid_losses = []
-    best_vloss = float("inf")
+    n_batches = len(trainloader)
+    log_every = max(1, n_batches // 10)
+    log_iters = frozenset(range(0, n_batches, log_every))
     net.train()
     while j < p:
         epoch += 1
-        N_BATCHES = len(trainloader)
+        # train metrics are accumulated during the epoch instead of running a
+        # second pass over the whole training set
+        running_loss = torch.zeros((), device=device)
+        running_acc = torch.zeros((), device=device)
+        running_n = 0
         for i, batch in enumerate(trainloader):
-            optimizer.zero_grad()
+            optimizer.zero_grad(set_to_none=True)
             X, y = batch
 
-            y = y.view(-1).to(device)
-            X = X.view(-1, 1, N_CHANNELS, TRIAL_LENGTH).float().to(device)
+            y = y.to(device, non_blocking=True)
+            X = X.to(device, non_blocking=True)
+            X = X.contiguous(memory_format=torch.channels_last)
 
-            net.train()
-            out = net.forward(X)
-            loss = criterion(out, y)
-            loss.backward()
-            optimizer.step()
-            print(
-                f"Epoch: {epoch} // Batch {i+1}/{N_BATCHES} // loss = {loss}", end="\r"
-            )
-
-        train_loss, train_acc = evaluate(net, trainloader, criterion)
-        valid_loss, valid_acc = evaluate(net, validloader, criterion)
+            with torch.amp.autocast("cuda", enabled=amp):
+                out = net.forward(X)
+                loss = criterion(out, y)
+            scaler.scale(loss).backward()
+            scaler.step(optimizer)
+            scaler.update()
+            n = y.size(0)
+            running_loss += loss.detach() * n
+            running_acc += accuracy(out.detach(), y) * n
+            running_n += n
+            if i in log_iters:
+                progress = (
+                    f"Epoch: {epoch} // Batch {i+1}/{n_batches}"
+                    f" // loss = {loss.item():.5f}"
+                )
+                print(progress, end="\r")
+
+        if eval_train:
+            train_loss, train_acc = evaluate(net, trainloader, criterion, amp)
+        else:
+            train_loss = (running_loss / running_n).item()
+            train_acc = (running_acc / running_n).item()
+        valid_loss, valid_acc = evaluate(net, validloader, criterion, amp)
+        net.train()
 
         train_accs.append(train_acc)
         train_losses.append(train_loss)
@@ -190,12 +383,23 @@ def train(
             best_epoch = epoch
             j = 0
             if save_model:
+                # .result() re-raises here any error from the previous writes
+                for future in pending:
+                    future.result()
+                pending = []
+                # snapshot the states now, training keeps updating them in place
+                net_state = {
+                    k: v.detach().to("cpu", copy=True)
+                    for k, v in unwrap(best_net).state_dict().items()
+                }
                 checkpoint = {
                     "epoch": epoch + 1,
-                    "state_dict": best_net.state_dict(),
-                    "optimizer": optimizer.state_dict(),
+                    "state_dict": net_state,
+                    "optimizer": copy.deepcopy(optimizer.state_dict()),
                 }
-                save_checkpoint(checkpoint, model_filepath)
+                pending.append(
+                    executor.submit(save_checkpoint, checkpoint, model_filepath)
+                )
                 net.save_model(save_path)
         else:
             j += 1
@@ -203,42 +407,56 @@ def train(
         print("Epoch: {}".format(epoch))
         print(" [LOSS] TRAIN {} / VALID {}".format(train_loss, valid_loss))
         print(" [ACC] TRAIN {} / VALID {}".format(train_acc, valid_acc))
-        if save_model:
-            results = {
-                "acc_score": [best_vacc],
-                "loss_score": [best_vloss],
-                "acc": valid_accs,
-                "train_acc": train_accs,
-                "valid_loss": valid_losses,
-                "train_loss": train_losses,
-                "best_epoch": best_epoch,
-                "n_epochs": epoch,
-            }
-            savemat(save_path + net.name + ".mat", results)
+        results = {
+            "acc_score": best_vacc,
+            "loss_score": best_vloss,
+            "acc": valid_accs,
+            "train_acc": train_accs,
+            "valid_loss": valid_losses,
+            "train_loss": train_losses,
+            "best_epoch": best_epoch,
+            "n_epochs": epoch,
+        }
+        # the history is only written along with a new best checkpoint, and
+        # once more when training stops
+        if save_model and j == 0:
+            pending.append(
+                executor.submit(save_results, copy.deepcopy(results), results_filepath)
+            )
+
+    if save_model:
+        pending.append(executor.submit(save_results, results, results_filepath))
+    executor.shutdown(wait=True)
+    for future in pending:
+        future.result()
+    if save_model and matlab_compat:
+        savemat(save_path + net.name + ".mat", results)
 
     return net
 
 
-def evaluate(net, dataloader, criterion=nn.CrossEntropyLoss()):
+def evaluate(net, dataloader, criterion=F.cross_entropy, amp=False):
     net.eval()
-    with torch.no_grad():
-        LOSSES = 0
-        ACCURACY = 0
+    with torch.inference_mode():
+        LOSSES = torch.zeros((), device=device)
+        ACCURACY = torch.zeros((), device=device)
         COUNTER = 0
         for batch in dataloader:
             X, y = batch
-            y = y.view(-1).to(device)
-            X = X.view(-1, 1, N_CHANNELS, TRIAL_LENGTH).float().to(device)
+            y = y.to(device, non_blocking=True)
+            X = X.to(device, non_blocking=True)
+            X = X.contiguous(memory_format=torch.channels_last)
 
-            out = net.forward(X)
-            loss = criterion(out, y)
+            with torch.amp.autocast("cuda", enabled=amp):
+                out = net.forward(X)
+                loss = criterion(out, y)
             acc = accuracy(out, y)
             n = y.size(0)
-            LOSSES += loss.sum().data.cpu().numpy() * n
-            ACCURACY += acc.sum().data.cpu().numpy() * n
+            LOSSES += loss.detach() * n
+            ACCURACY += acc.detach() * n
             COUNTER += n
-        floss = LOSSES / float(COUNTER)
-        faccuracy = ACCURACY / float(COUNTER)
+        floss = (LOSSES / COUNTER).item()
+        faccuracy = (ACCURACY / COUNTER).item()
     return floss, faccuracy
 
 
@@ -252,6 +470,9 @@ class FullNet(nn.Module):
         n_linear=150,
         dropout=0.3,
         dropout_option="same",
+        checkpoint=False,
+        fused=False,
+        spatial_linear=False,
     ):
         if dropout_option == "same":
             dropout1 = dropout
@@ -270,14 +491,32 @@ class FullNet(nn.Module):
                 print(f"{dropout_option} is not a valid option")
 
         super(FullNet, self).__init__()
-        layers = nn.ModuleList(
-            [
+        if fused:
+            # one (N_CHANNELS, filter_size) kernel instead of the temporal then
+            # spatial pair, not compatible with checkpoints of the unfused net
+            first_block = [
+                nn.Conv2d(1, 5 * n_channels, (N_CHANNELS, filter_size)),
+                nn.BatchNorm2d(5 * n_channels),
+                nn.ReLU(),
+            ]
+        else:
+            if spatial_linear:
+                # the spatial conv spans all the sensors, it is a linear layer
+                # applied at each time point
+                spatial = SpatialLinear(5 * n_channels, 5 * n_channels, N_CHANNELS)
+            else:
+                spatial = nn.Conv2d(5 * n_channels, 5 * n_channels, (N_CHANNELS, 1))
+            first_block = [
                 nn.Conv2d(1, 5 * n_channels, (1, filter_size)),
                 nn.BatchNorm2d(5 * n_channels),
                 nn.ReLU(),
-                nn.Conv2d(5 * n_channels, 5 * n_channels, (N_CHANNELS, 1)),
+                spatial,
                 nn.BatchNorm2d(5 * n_channels),
                 nn.ReLU(),
+            ]
+        layers = nn.ModuleList(
+            first_block
+            + [
                 nn.MaxPool2d((1, 5)),
                 nn.Conv2d(5 * n_channels, 8 * n_channels, (1, int(filter_size / 10))),
                 nn.BatchNorm2d(8 * n_channels),
@@ -290,7 +529,14 @@ class FullNet(nn.Module):
             ]
         )
 
-        lin_size = nn.Sequential(*layers)(torch.zeros(input_size)).shape[-1]
+        height, width = input_size[-2:]
+        width = _conv_out(width, filter_size)
+        height = _conv_out(height, N_CHANNELS)
+        width = _conv_out(width, 5, 5)
+        width = _conv_out(width, int(filter_size / 10))
+        width = _conv_out(width, 5, 5)
+        width = _conv_out(width, int(filter_size / 5))
+        lin_size = 16 * n_channels * height * width
 
         layers.extend(
             (
@@ -301,10 +547,14 @@ class FullNet(nn.Module):
             )
         )
 
-        self.model = nn.Sequential(*layers)
+        self.model = nn.Sequential(*layers).to(memory_format=torch.channels_last)
         self.name = model_name
+        self.checkpoint = checkpoint
 
     def forward(self, x):
+        if self.checkpoint and self.training:
+            # activations are recomputed during backward instead of stored
+            return checkpoint_sequential(self.model, 3, x)
         return self.model(x)
 
     def save_model(self, filepath="."):
@@ -319,7 +569,7 @@ class FullNet(nn.Module):
 
 
 class vanPutNet(nn.Module):
-    def __init__(self, model_name, input_size, dropout=0.25):
+    def __init__(self, model_name, input_size, dropout=0.25, checkpoint=False):
 
         super(vanPutNet, self).__init__()
         layers = nn.ModuleList(
@@ -343,15 +593,29 @@ class vanPutNet(nn.Module):
             ]
         )
 
-        lin_size = nn.Sequential(*layers)(torch.zeros(input_size)).shape[-1]
+        height, width = input_size[-2:]
+        height, width = _conv_out(height, 3), _conv_out(width, 3)
+        height, width = _conv_out(height, 2, 2), _conv_out(width, 2, 2)
+        height, width = _conv_out(height, 3), _conv_out(width, 3)
+        height, width = _conv_out(height, 2, 2), _conv_out(width, 2, 2)
+        height, width = _conv_out(height, 2), _conv_out(width, 3)
+        height, width = _conv_out(height, 2, 2), _conv_out(width, 2, 2)
+        width = _conv_out(width, 7)
+        height, width = _conv_out(height, 2, 2), _conv_out(width, 2, 2)
+        width = _conv_out(width, 3)
+        width = _conv_out(width, 3)
+        lin_size = 100 * height * width
 
         layers.append(nn.Linear(lin_size, 2))
 
-        self.model = nn.Sequential(*layers)
+        self.model = nn.Sequential(*layers).to(memory_format=torch.channels_last)
 
         self.name = model_name
+        self.checkpoint = checkpoint
 
     def forward(self, x):
+        if self.checkpoint and self.training:
+            return checkpoint_sequential(self.model, 3, x)
         return self.model(x)
 
     def save_model(self, filepath="."):
@@ -371,6 +635,10 @@ if __name__ == "__main__":
 
     if torch.cuda.is_available():
         device = "cuda"
+        # input shapes are fixed for a run so cudnn autotuning pays off
+        torch.backends.cudnn.benchmark = True
+        torch.backends.cuda.matmul.allow_tf32 = True
+        torch.backends.cudnn.allow_tf32 = True
     else:
         device = "cpu"
 
@@ -407,6 +675,7 @@ if __name__ == "__main__":
     SEED = 420
 
     debug = args.debug
+    amp = args.amp and torch.cuda.is_available()
     filters = args.filters
     nchan = args.nchan
     dropout = args.dropout
@@ -434,9 +703,39 @@ if __name__ == "__main__":
     # lin_size = compute_lin_size(np.zeros((2, 1, N_CHANNELS, TRIAL_LENGTH)), net)
 
     input_size = (BATCH_SIZE, 1, N_CHANNELS, TRIAL_LENGTH)
-    net = vanPutNet("van_Putten_network", input_size, dropout=dropout).to(device)
+    net = vanPutNet(
+        "van_Putten_network", input_size, dropout=dropout, checkpoint=args.checkpoint
+    ).to(device)
     print(net)
     print(summary(net, (1, N_CHANNELS, TRIAL_LENGTH)))
+    if args.compile:
+        state = copy.deepcopy(net.state_dict())
+        try:
+            if hasattr(torch, "compile"):
+                # batches only differ in size for the last batch of each loader,
+                # a handful of static graphs is enough for a whole run
+                torch._dynamo.config.cache_size_limit = 16
+                net = torch.compile(
+                    net, mode="reduce-overhead", fullgraph=False, dynamic=False
+                )
+                # torch.compile only wraps the net, compilation happens on the first
+                # call: run a training step here so that a failure falls back to eager
+                dummy = torch.zeros(
+                    BATCH_SIZE, 1, N_CHANNELS, TRIAL_LENGTH, device=device
+                ).contiguous(memory_format=torch.channels_last)
+                with torch.amp.autocast("cuda", enabled=amp):
+                    out = net(dummy)
+                out.float().sum().backward()
+            else:
+                net.model = torch.jit.script(net.model)
+        except Exception as e:
+            print(f"Warning: could not compile the network, running eagerly ({e})")
+            net = unwrap(net)
+            if hasattr(torch, "compile"):
+                torch._dynamo.reset()
+        # the warm-up step must not leak into training
+        unwrap(net).load_state_dict(state)
+        net.zero_grad(set_to_none=True)
 
     a = time()
     trainloader, validloader, testloader = create_loaders(
@@ -447,7 +746,19 @@ if __name__ == "__main__":
         CH_TYPE,
         DATA_TYPE,
         seed=SEED,
+        pin_memory=torch.cuda.is_available() and not args.no_pin_memory,
+        num_workers=args.num_workers,
+        prefetch_factor=args.prefetch_factor,
+        h5_file=args.h5_file,
     )
+    if device == "cuda":
+        loaders = []
+        for loader in (trainloader, validloader, testloader):
+            if args.in_memory_gpu and fits_on_gpu(loader.dataset, device):
+                loaders.append(GPUBatchLoader(loader, device))
+            else:
+                loaders.append(CudaPrefetcher(loader, device))
+        trainloader, validloader, testloader = loaders
     print(elapsed_time(time(), a))
 
     if args.mode == "overwrite":
@@ -461,16 +772,22 @@ if __name__ == "__main__":
         loaf = False
 
     model_filepath = save_path + net.name + ".pt"
+    # a single loss function shared by training and the final evaluation
+    criterion = F.cross_entropy
     train(
         net,
         trainloader,
         validloader,
         model_filepath,
+        criterion=criterion,
         save_model=save,
         load_model=load,
         debug=debug,
+        amp=amp,
+        matlab_compat=args.matlab_compat,
+        eval_train=args.eval_train,
     )
     _, net_state, _ = load_checkpoint(model_filepath)
-    net.load_state_dict(net_state)
+    unwrap(net).load_state_dict(net_state)
 
-    print(evaluate(net, testloader))
+    print(evaluate(fuse_conv_bn(net), testloader, criterion, amp=amp))
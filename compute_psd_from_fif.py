@@ -35,16 +35,19 @@ def compute_psd(signal, segment_size, sf, window, overlap):
     n_segs = int(signal_length / segment_size)
     padding = int((signal_length - n_segs * segment_size) / 2)
 
+    # one welch call per segment: batching them only materializes every
+    # segment's windows at once, the FFTs cost the same
     data = []
     for i in range(padding, signal_length, segment_size):
         segment = signal[:, i : i + segment_size]
-        f, psd = welch(segment, fs=sf, window="hamming", nperseg=window, nfft=None)
-        data.append(psd[:, (f >= 0) * (f <= 120)])
-        f = f[(f >= 0) * (f <= 120)]
-    if data[-1].shape[1] != data[0].shape[1]:
-        return f, np.asarray(data[:-1])
-    else:
-        return f, np.asarray(data)
+        f_seg, psd = welch(segment, fs=sf, window="hamming", nperseg=window, nfft=None)
+        freqs = (f_seg >= 0) * (f_seg <= 120)
+        # a shorter last segment gives other frequency bins, it is dropped
+        if data and freqs.sum() != data[0].shape[1]:
+            break
+        data.append(psd[:, freqs])
+        f = f_seg[freqs]
+    return f, np.asarray(data)
 
 
 def compute_save_psd(
@@ -1,34 +1,85 @@
 from __future__ import print_function, division
 from time import time
+from functools import lru_cache
 import os
 import torch
 import pandas as pd
 import numpy as np
-from scipy.stats import zscore
 from torch.utils.data import Dataset, DataLoader, random_split, TensorDataset
 from params import CHAN_DF
 
 
+BANDS = ((0.5, 4), (4, 8), (8, 12), (12, 30), (30, 120))
+
+
+@lru_cache(maxsize=None)
+def _band_edges(nfreq):
+    """Indices for np.add.reduceat and bounds of the frequency bands.
+
+    The psd bins are 0.5Hz apart and both band limits are included, so
+    consecutive bands share one bin. The indices alternate between the start
+    and the end of each band: the sums at odd positions are discarded. They are
+    None when the spectrum stops inside a band that is not the last one, reduceat
+    can not express that end.
+    """
+    f = np.arange(nfreq) / 2
+    lo = np.searchsorted(f, [fmin for fmin, _ in BANDS], side="left")
+    hi = np.searchsorted(f, [fmax for _, fmax in BANDS], side="right")
+    for (fmin, fmax), start, stop in zip(BANDS, lo, hi):
+        if start >= stop:
+            raise ValueError(
+                f"The {fmin}-{fmax}Hz band has no bins in a psd of {nfreq} frequencies"
+            )
+    indices = np.stack((lo, hi), axis=-1).ravel()
+    if indices[-1] == nfreq:
+        indices = indices[:-1]
+    if indices.max() >= nfreq:
+        indices = None
+    return indices, lo, hi
+
+
 def extract_bands(data):
+    add_axis = False
     if len(data.shape) < 3:
         data = data[np.newaxis, :, :]
         add_axis = True
-    f = np.asarray([float(i / 2) for i in range(data.shape[-1])])
-    # data = data[:, :, (f >= 8) * (f <= 12)].mean(axis=2)
-    data = [
-        data[:, :, (f >= 0.5) * (f <= 4)].mean(axis=-1)[..., None],
-        data[:, :, (f >= 4) * (f <= 8)].mean(axis=-1)[..., None],
-        data[:, :, (f >= 8) * (f <= 12)].mean(axis=-1)[..., None],
-        data[:, :, (f >= 12) * (f <= 30)].mean(axis=-1)[..., None],
-        data[:, :, (f >= 30) * (f <= 120)].mean(axis=-1)[..., None],
-    ]
-    data = np.concatenate(data, axis=2)
+    indices, lo, hi = _band_edges(data.shape[-1])
+    out = np.empty(
+        data.shape[:-1] + (len(BANDS),), dtype=np.promote_types(data.dtype, np.float32)
+    )
+    if indices is None:
+        for b, (start, stop) in enumerate(zip(lo, hi)):
+            data[..., start:stop].sum(axis=-1, out=out[..., b])
+        sums = out
+    else:
+        sums = np.add.reduceat(data, indices, axis=-1)[..., ::2]
+    np.divide(sums, hi - lo, out=out)
     if add_axis:
-        return data[0]
-    return data
+        return out[0]
+    return out
+
+
+def _zscore(x, axis=0):
+    """Same as scipy.stats.zscore, computed in float32.
+
+    Works in place when x is already a float32 array.
+    """
+    x = np.asarray(x, dtype=np.float32)
+    x -= x.mean(axis=axis, keepdims=True)
+    x /= np.sqrt((x * x).mean(axis=axis, keepdims=True))
+    return x
 
 
-def create_dataset(data_df, data_path, ch_type, debug=False):
+@lru_cache(maxsize=32)
+def _load_mmap(path):
+    """Memory maps a .npy file, only the pages that get indexed are read.
+
+    The cache is per process so each DataLoader worker keeps its own handles.
+    """
+    return np.load(path, mmap_mode="r")
+
+
+def create_dataset(data_df, data_path, ch_type, debug=False, h5_file=None):
     if ch_type == "MAG":
         elec_index = list(range(2, 306, 3))
     elif ch_type == "GRAD":
@@ -38,7 +89,11 @@ def create_dataset(data_df, data_path, ch_type, debug=False):
         elec_index = list(range(306))
 
     meg_dataset = megDataset(
-        data_df=data_df, root_dir=data_path, elec_index=elec_index, debug=debug
+        data_df=data_df,
+        root_dir=data_path,
+        elec_index=elec_index,
+        debug=debug,
+        h5_file=h5_file,
     )
 
     return meg_dataset
@@ -54,7 +109,14 @@ def create_loaders(
     method="new",
     debug=False,
     seed=0,
+    pin_memory=None,
+    num_workers=4,
+    prefetch_factor=2,
+    h5_file=None,
 ):
+    # Pinned batches only pay off when they are copied with non_blocking=True
+    if pin_memory is None:
+        pin_memory = torch.cuda.is_available()
     rng = np.random.RandomState(seed)
     torch.manual_seed(seed)
     # Using trials_df ensures we use the correct subjects that do not give errors since
@@ -105,81 +167,246 @@ def create_loaders(
             debug=debug,
         )
 
-        train_set = TensorDataset(X_train, y_train)
-        valid_set = TensorDataset(X_valid, y_valid)
-        test_set = TensorDataset(X_test, y_test)
+        train_set = TensorDataset(X_train.unsqueeze(1), y_train)
+        valid_set = TensorDataset(X_valid.unsqueeze(1), y_valid)
+        test_set = TensorDataset(X_test.unsqueeze(1), y_test)
     else:
         train_df = samples_df.loc[samples_df["subs"].isin(subs[train_index])]
-        train_set = create_dataset(train_df, data_folder, ch_type, debug=debug)
+        train_set = create_dataset(
+            train_df, data_folder, ch_type, debug=debug, h5_file=h5_file
+        )
 
         valid_df = samples_df.loc[samples_df["subs"].isin(subs[valid_index])]
-        valid_set = create_dataset(valid_df, data_folder, ch_type, debug=debug)
+        valid_set = create_dataset(
+            valid_df, data_folder, ch_type, debug=debug, h5_file=h5_file
+        )
 
         test_df = samples_df.loc[samples_df["subs"].isin(subs[test_index])]
-        test_set = create_dataset(test_df, data_folder, ch_type, debug=debug)
+        test_set = create_dataset(
+            test_df, data_folder, ch_type, debug=debug, h5_file=h5_file
+        )
 
     # loading data with num_workers=0 seems faster that using more.
     # Maybe because of IO read speeds.
+    if num_workers > os.cpu_count() // 2:
+        print(
+            f"Warning: {num_workers} workers for {os.cpu_count()} cpus,"
+            " workers may end up competing with each other."
+        )
+    # workers are kept alive between epochs instead of being respawned.
+    # prefetch_factor defaults to 2 because each batch queued ahead is pinned host
+    # memory, held num_workers times over by each of the three loaders
+    worker_kwargs = {}
+    if num_workers > 0:
+        worker_kwargs = dict(persistent_workers=True, prefetch_factor=prefetch_factor)
     train_loader = DataLoader(
-        train_set, batch_size=batch_size, shuffle=True, num_workers=4, pin_memory=True
+        train_set,
+        batch_size=batch_size,
+        shuffle=True,
+        num_workers=num_workers,
+        pin_memory=pin_memory,
+        **worker_kwargs,
     )
     valid_loader = DataLoader(
-        valid_set, batch_size=batch_size, shuffle=True, num_workers=4, pin_memory=True
+        valid_set,
+        batch_size=batch_size,
+        shuffle=True,
+        num_workers=num_workers,
+        pin_memory=pin_memory,
+        **worker_kwargs,
     )
     test_loader = DataLoader(
-        test_set, batch_size=batch_size, shuffle=True, num_workers=4, pin_memory=True
+        test_set,
+        batch_size=batch_size,
+        shuffle=True,
+        num_workers=num_workers,
+        pin_memory=pin_memory,
+        **worker_kwargs,
     )
 
     return train_loader, valid_loader, test_loader
 
 
+class CudaPrefetcher:
+    """Wraps a DataLoader and copies the next batch to the GPU on a side stream.
+
+    The copy of batch i+1 is issued while batch i is being used on the
+    default stream, the wrapper can be iterated over once per epoch.
+    """
+
+    def __init__(self, loader, device="cuda"):
+        self.loader = loader
+        self.device = device
+        self.stream = torch.cuda.Stream(device)
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        self.loader_iter = iter(self.loader)
+        self._preload()
+        return self
+
+    def _preload(self):
+        try:
+            X, y = next(self.loader_iter)
+        except StopIteration:
+            self.next_X, self.next_y = None, None
+            return
+        with torch.cuda.stream(self.stream):
+            self.next_X = X.to(self.device, non_blocking=True)
+            self.next_y = y.to(self.device, non_blocking=True)
+
+    def __next__(self):
+        torch.cuda.current_stream().wait_stream(self.stream)
+        X, y = self.next_X, self.next_y
+        if X is None:
+            raise StopIteration
+        X.record_stream(torch.cuda.current_stream())
+        y.record_stream(torch.cuda.current_stream())
+        self._preload()
+        return X, y
+
+
+class GPUBatchLoader:
+    """Keeps all the samples of a DataLoader on the GPU and yields slices of them.
+
+    The loader is read once, after that an epoch is only a shuffle and
+    contiguous slicing on the device: no workers, no pinning, no copies.
+    """
+
+    def __init__(self, loader, device="cuda"):
+        X, y = zip(*loader)
+        self.X = torch.cat(X).to(device)
+        self.y = torch.cat(y).to(device)
+        self.batch_size = loader.batch_size
+        self.device = device
+
+    def __len__(self):
+        return -(-len(self.y) // self.batch_size)
+
+    def __iter__(self):
+        perm = torch.randperm(len(self.y), device=self.device)
+        X, y = self.X[perm], self.y[perm]
+        for i in range(0, len(y), self.batch_size):
+            yield X[i : i + self.batch_size], y[i : i + self.batch_size]
+
+
+def fits_on_gpu(dataset, device="cuda"):
+    """Checks that the dataset takes less than half of the free GPU memory."""
+    if isinstance(dataset, TensorDataset):
+        sample_nbytes = dataset.tensors[0][0].nbytes
+    else:
+        X, _ = dataset[0]
+        sample_nbytes = X.nbytes
+        # the HDF5 store is opened lazily so that each worker gets its own handle,
+        # the probe must not leave one open in the parent before the fork
+        if getattr(dataset, "_h5", None) is not None:
+            dataset._h5.close()
+            dataset._h5 = None
+    nbytes = len(dataset) * sample_nbytes
+    return nbytes < 0.5 * torch.cuda.mem_get_info(device)[0]
+
+
 class megDataset(Dataset):
     """Face Landmarks dataset."""
 
-    def __init__(self, data_df, root_dir, elec_index, dtype="temporal", debug=False):
+    def __init__(
+        self,
+        data_df,
+        root_dir,
+        elec_index,
+        dtype="temporal",
+        debug=False,
+        h5_file=None,
+    ):
         """
         Args:
             csv_file (string): Path to the csv file with annotations.
             root_dir (string): Directory with all the images.
             transform (callable, optional): Optional transform to be applied
                 on a sample.
+            h5_file (string, optional): HDF5 store written by npy2h5.py, temporal
+                samples are then sliced from it instead of read from one file each.
         """
         self.data_df = data_df
         self.root_dir = root_dir
         self.elec_index = elec_index
         self.dtype = dtype
         self.debug = debug
+        self.h5_file = h5_file
+        # opened on first use so that each worker gets its own handle
+        self._h5 = None
+        # plain arrays, indexing them is much cheaper than .iloc in every worker
+        self._subs = data_df["subs"].to_numpy()
+        self._sex = data_df["sex"].to_numpy(np.int64)
+        self._begin = data_df["begin"].to_numpy(np.int64)
+        self._end = data_df["end"].to_numpy(np.int64)
+        # sample file names are built once here rather than in every __getitem__
+        if dtype == "temporal":
+            names = (
+                f"{sub}_{sex}_{begin}_{end}_ICA_ds200.npy"
+                for sub, sex, begin, end in zip(
+                    self._subs, self._sex, self._begin, self._end
+                )
+            )
+        else:
+            names = (f"{sub}_psd.npy" for sub in self._subs)
+        self._paths = [os.path.join(root_dir, name) for name in names]
 
     def __len__(self):
         return len(self.data_df)
 
+    def _read_h5(self, sub, begin, end):
+        if self._h5 is None:
+            import h5py
+
+            self._h5 = h5py.File(self.h5_file, "r")
+            n_channels = self._h5.attrs.get("n_channels", len(self.elec_index))
+            if n_channels != len(self.elec_index):
+                raise ValueError(
+                    f"{self.h5_file} holds {n_channels} normalized channels,"
+                    f" {len(self.elec_index)} were asked for"
+                )
+        signal = self._h5[f"subj/{sub}/signal"]
+        if "elec" in self._h5.attrs:
+            # written with npy2h5.py --elec: already z-scored, a plain slice is enough
+            return signal[:, begin:end]
+        # h5py only takes sorted channel lists, pick the channels after the read
+        return _zscore(signal[:, begin:end][self.elec_index], axis=0)
+
     def __getitem__(self, idx):
         if torch.is_tensor(idx):
             idx = idx.tolist()
 
         if self.debug:
-            return {"subject": "test", "sex": 0, "trial": np.zeros((102, 400))}
+            trial = torch.zeros((1, len(self.elec_index), 400))
+            return trial, torch.tensor(0, dtype=torch.long)
 
-        sub = self.data_df["subs"].iloc[idx]
-        sex = self.data_df["sex"].iloc[idx]
-        begin = self.data_df["begin"].iloc[idx]
-        end = self.data_df["end"].iloc[idx]
+        sub = self._subs[idx]
+        sex = self._sex[idx]
+        begin = self._begin[idx]
+        end = self._end[idx]
+        data_path = self._paths[idx]
 
         if self.dtype == "temporal":
-            data_path = os.path.join(
-                self.root_dir, f"{sub}_{sex}_{begin}_{end}_ICA_ds200.npy"
-            )
-            trial = np.load(data_path)[self.elec_index]
-            trial = zscore(trial, axis=0)
+            if self.h5_file is not None:
+                trial = self._read_h5(sub, begin, end)
+            else:
+                trial = _load_mmap(data_path)[self.elec_index]
+                trial = _zscore(trial.astype(np.float32, copy=False), axis=0)
             if np.isnan(np.sum(trial)):
                 print(data_path, "becomes nan")
+            # add the single input plane expected by the conv nets
+            trial = trial[np.newaxis]
         else:
-            data_path = os.path.join(self.root_dir, f"{sub}_psd.npy")
-            trial = np.load(data_path)[:, self.elec_index]
+            trial = _load_mmap(data_path)[:, self.elec_index]
+            trial = trial.astype(np.float32, copy=False)
             if self.dtype == "bands":
                 trial = extract_bands(trial)
 
-        sample = (trial, sex)
+        # tensors are built here, in the workers, so batches are ready to be pinned
+        sample = (torch.from_numpy(trial), torch.tensor(sex, dtype=torch.long))
 
         return sample
 
@@ -197,26 +424,33 @@ def load_freq_data(dataframe, dpath, ch_type="MAG", bands=True, debug=False):
         # Not currently working
         print("ENTERING DEBUG MODE")
         nb = 5 if bands else 241
-        dummy = np.zeros((25000, len(elec_index), nb))
-        return torch.Tensor(dummy).float(), torch.Tensor(dummy).float()
+        dummy = np.zeros((25000, len(elec_index), nb), dtype=np.float32)
+        return torch.from_numpy(dummy), torch.from_numpy(dummy)
 
-    X = None
-    y = []
+    buffers = []
+    labels = []
     i = 0
-    for row in dataframe.iterrows():
+    for sub, lab in dataframe[["participant_id", "sex"]].itertuples(index=False):
         print(f"loading subject {i+1}...")
-        sub, lab = row[1]["participant_id"], row[1]["sex"]
         try:
-            sub_data = np.array(np.load(dpath + f"{sub}_psd.npy"))[:, elec_index]
+            sub_data = np.load(dpath + f"{sub}_psd.npy")[:, elec_index]
+            sub_data = sub_data.astype(np.float32, copy=False)
         except:
             print("There was a problem loading subject ", sub)
-
-        X = sub_data if X is None else np.concatenate((X, sub_data), axis=0)
-        y += [lab] * len(sub_data)
+            continue
+        # bands are extracted per subject so only the reduced arrays are kept
+        buffers.append(extract_bands(sub_data) if bands else sub_data)
+        labels.append(lab)
         i += 1
-    if bands:
-        X = extract_bands(X)
-    return torch.Tensor(X).float(), torch.Tensor(y).long()
+
+    sizes = [len(b) for b in buffers]
+    X = np.empty((sum(sizes),) + buffers[0].shape[1:], dtype=np.float32)
+    off = 0
+    for b in buffers:
+        X[off : off + len(b)] = b
+        off += len(b)
+    y = np.repeat(np.asarray(labels, dtype=np.int64), sizes)
+    return torch.from_numpy(X), torch.from_numpy(y)
 
 
 def load_data(
@@ -236,32 +470,37 @@ def load_data(
     if debug:
         # Not currently working
         nb = trial_length
-        dummy = np.zeros((17439, len(elec_index), nb))
-        return torch.Tensor(dummy).float(), torch.tensor(dummy).float()
+        dummy = np.zeros((17439, len(elec_index), nb), dtype=np.float32)
+        return torch.from_numpy(dummy), torch.from_numpy(dummy)
 
-    X = None
-    y = []
-    i = 0
-    for row in dataframe.iterrows():
-        print(f"loading subject {i+1}/{len(dataframe)}", end="\r")
-        sub, lab = row[1]["participant_id"], row[1]["sex"]
+    # First pass only reads the headers so X can be allocated once.
+    paths, labels, n_segs = [], [], []
+    for sub, lab in dataframe[["participant_id", "sex"]].itertuples(index=False):
+        path = dpath + f"{sub}_ICA_transdef_mfds200.npy"
         try:
-            sub_data = np.load(dpath + f"{sub}_ICA_transdef_mfds200.npy")[elec_index]
+            n_times = np.load(path, mmap_mode="r").shape[-1]
         except:
             print("There was a problem loading subject ", sub)
             continue
-        sub_data = [
-            normalize(sub_data[:, i : i + trial_length])
-            for i in range(offset, sub_data.shape[-1], trial_length)
-            if i + trial_length < sub_data.shape[-1]
-        ]
-        sub_data = np.array(sub_data)
-        X = sub_data if X is None else np.concatenate((X, sub_data), axis=0)
-        y += [lab] * len(sub_data)
-        # y += [i] * len(sub_data)
-        i += 1
+        paths.append(path)
+        labels.append(lab)
+        n_segs.append(len(range(offset, n_times - trial_length, trial_length)))
+
+    offsets = np.concatenate(([0], np.cumsum(n_segs, dtype=np.int64)))
+    X = np.empty((offsets[-1], len(elec_index), trial_length), dtype=np.float32)
+    y = np.repeat(np.asarray(labels, dtype=np.int64), n_segs)
+    for i, path in enumerate(paths):
+        print(f"loading subject {i+1}/{len(paths)}", end="\r")
+        sub_data = np.load(path)[elec_index].astype(np.float32, copy=False)
+        # segments are contiguous and non overlapping, so they are a reshape away
+        n_seg = offsets[i + 1] - offsets[i]
+        segments = sub_data[:, offset : offset + n_seg * trial_length]
+        segments = segments.reshape(len(elec_index), n_seg, trial_length)
+        out = X[offsets[i] : offsets[i + 1]]
+        out[:] = segments.transpose(1, 0, 2)
+        _zscore(out, axis=1)
     print(X.shape, len(y))
-    return torch.Tensor(X).float(), torch.Tensor(y).long()
+    return torch.from_numpy(X), torch.from_numpy(y)
 
 
 def load_subject(sub, data_path, data=None, timepoints=500, ch_type="all"):
@@ -283,13 +522,17 @@ def load_subject(sub, data_path, data=None, timepoints=500, ch_type="all"):
         n_channels = 204
     else:
         raise ("Error : bad channel type selected")
-    trial = trial[mask]
+    trial = trial[mask].astype(np.float32, copy=False)
 
     n_trials = trial.shape[-1] // timepoints
-    for i in range(1, n_trials - 1):
-        curr = trial[:, i * timepoints : (i + 1) * timepoints]
-        curr = curr.reshape(1, n_channels, timepoints)
-        data = curr if data is None else np.concatenate((data, curr))
+    # trials already in data are copied in front, the result is always float32
+    n_prev = 0 if data is None else len(data)
+    out = np.empty((n_prev + n_trials - 2, n_channels, timepoints), dtype=np.float32)
+    if data is not None:
+        out[:n_prev] = data
+    # the first and last trials are dropped, the others tile the recording
+    curr = trial[:, timepoints : (n_trials - 1) * timepoints]
+    curr = curr.reshape(n_channels, n_trials - 2, timepoints).transpose(1, 0, 2)
+    out[n_prev:] = curr
     labels = [sex] * (n_trials - 2)
-    data = data.astype(np.float32, copy=False)
-    return data, labels
+    return out, labels
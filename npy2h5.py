@@ -0,0 +1,71 @@
+"""Gathers the subject recordings in a single HDF5 store.
+
+megDataset reads one small .npy per trial, which means thousands of open calls per
+epoch. With --h5-file it slices the trials out of this store instead.
+
+With --elec, only those channels are stored, already z-scored. The z-score is taken
+across channels at each time point, so normalizing whole recordings once gives the
+same trials as normalizing each of them every epoch.
+"""
+import argparse
+import numpy as np
+import pandas as pd
+import h5py
+from params import TIME_TRIAL_LENGTH
+from dataloaders import _zscore
+
+parser = argparse.ArgumentParser()
+parser.add_argument(
+    "-p",
+    "--path",
+    type=str,
+    help="The path where the subject recordings (*_ICA_transdef_mfds200.npy) are.",
+)
+parser.add_argument(
+    "-o",
+    "--out",
+    default="data.h5",
+    type=str,
+    help="The HDF5 file to create, default=data.h5",
+)
+parser.add_argument(
+    "-e",
+    "--elec",
+    default=None,
+    choices=["GRAD", "MAG", "ALL"],
+    help="only store these electrodes, z-scored, default keeps all raw channels",
+)
+args = parser.parse_args()
+
+
+def npy2h5(subs, dpath, out_file, ch_type=None):
+    if ch_type == "MAG":
+        elec_index = list(range(2, 306, 3))
+    elif ch_type == "GRAD":
+        elec_index = list(range(0, 306, 3))
+        elec_index += list(range(1, 306, 3))
+    elif ch_type == "ALL":
+        elec_index = list(range(306))
+
+    with h5py.File(out_file, "w") as f:
+        if ch_type is not None:
+            f.attrs["elec"] = ch_type
+            f.attrs["n_channels"] = len(elec_index)
+        for k, sub in enumerate(subs):
+            print(f"writing subject {k+1}/{len(subs)}", end="\r")
+            sub_data = np.load(dpath + f"{sub}_ICA_transdef_mfds200.npy")
+            if ch_type is not None:
+                sub_data = _zscore(sub_data[elec_index], axis=0)
+            # one chunk per trial: trials start at OFFSET + k * TIME_TRIAL_LENGTH
+            f.create_dataset(
+                f"subj/{sub}/signal",
+                data=sub_data.astype(np.float32, copy=False),
+                chunks=(sub_data.shape[0], TIME_TRIAL_LENGTH),
+            )
+    print()
+
+
+if __name__ == "__main__":
+    samples_df = pd.read_csv("./trials_df_clean.csv", index_col=0)
+    subs = sorted(set(samples_df["subs"]))
+    npy2h5(subs, args.path, args.out, args.elec)